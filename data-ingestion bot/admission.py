@@ -0,0 +1,149 @@
+# admission.py
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Pressure thresholds, as a fraction of the tightest limit
+HIGH_PRESSURE = 0.7
+SATURATED = 1.0
+
+
+class Overloaded(Exception):
+    """The pipeline is saturated; the job should be deferred and retried later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def directory_size(path):
+    """Total size in bytes of all files under `path`."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class AdmissionController:
+    """Bound the work in flight per pipeline stage and the bytes kept on disk.
+
+    `limits` maps a stage name (e.g. 'downloads') to the maximum number of jobs
+    allowed in it at once; 0 means unlimited. `max_disk_bytes` caps the size of
+    `media_dir`; 0 disables the check.
+
+    In-flight counts are per process, but `media_dir` is shared by every worker:
+    its size is re-measured every `disk_rescan_interval` seconds so other
+    workers' downloads and compaction passes are picked up.
+    """
+
+    def __init__(self, limits, max_disk_bytes=0, media_dir='media', slot_wait=30, retry_after=30,
+                 disk_rescan_interval=60):
+        self.limits = dict(limits)
+        self.max_disk_bytes = max_disk_bytes
+        self.media_dir = media_dir
+        self.slot_wait = slot_wait
+        self.retry_after = retry_after
+        self.disk_rescan_interval = disk_rescan_interval
+        self._in_flight = {stage: 0 for stage in self.limits}
+        self._condition = threading.Condition()
+        self._disk_bytes = directory_size(media_dir) if max_disk_bytes else 0
+        self._level = 'ok'
+        if max_disk_bytes and disk_rescan_interval:
+            threading.Thread(target=self._rescan_loop, name='disk-rescan', daemon=True).start()
+
+    def _rescan_loop(self):
+        while True:
+            time.sleep(self.disk_rescan_interval)
+            self.rescan_disk()
+
+    def rescan_disk(self):
+        """Replace the running disk estimate with the measured size of `media_dir`."""
+        measured = directory_size(self.media_dir)
+        with self._condition:
+            self._disk_bytes = measured
+            self._update_level()
+
+    def _utilization(self):
+        ratios = {
+            stage: self._in_flight[stage] / limit
+            for stage, limit in self.limits.items() if limit
+        }
+        if self.max_disk_bytes:
+            ratios['disk'] = self._disk_bytes / self.max_disk_bytes
+        return ratios
+
+    def _update_level(self):
+        pressure = max(self._utilization().values(), default=0.0)
+        if pressure >= SATURATED:
+            level = 'saturated'
+        elif pressure >= HIGH_PRESSURE:
+            level = 'high'
+        else:
+            level = 'ok'
+        if level != self._level:
+            logger.warning(f"Pipeline pressure changed: {self._level} -> {level} ({pressure:.0%})")
+            self._level = level
+
+    @property
+    def level(self):
+        with self._condition:
+            return self._level
+
+    def snapshot(self):
+        """Current pressure level, in-flight counts and disk usage."""
+        with self._condition:
+            return {
+                'level': self._level,
+                'stages': {
+                    stage: {'in_flight': self._in_flight[stage], 'limit': limit}
+                    for stage, limit in self.limits.items()
+                },
+                'disk': {'bytes': self._disk_bytes, 'limit': self.max_disk_bytes},
+            }
+
+    def saturated(self, stages):
+        """True if any of `stages` is at its limit or the disk budget is used up."""
+        with self._condition:
+            if self.max_disk_bytes and self._disk_bytes >= self.max_disk_bytes:
+                return True
+            return any(
+                self.limits[stage] and self._in_flight[stage] >= self.limits[stage]
+                for stage in stages
+            )
+
+    def check(self, stages):
+        if self.saturated(stages):
+            raise Overloaded(f"Pipeline saturated ({', '.join(stages)}).", self.retry_after)
+
+    @contextmanager
+    def slot(self, stage, wait=None):
+        """Hold one place in `stage`, waiting up to `wait` seconds (default `slot_wait`) for it."""
+        limit = self.limits[stage]
+        if wait is None:
+            wait = self.slot_wait
+        with self._condition:
+            if limit and not self._condition.wait_for(lambda: self._in_flight[stage] < limit, wait):
+                raise Overloaded(f"No free {stage} slot.", self.retry_after)
+            self._in_flight[stage] += 1
+            self._update_level()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight[stage] -= 1
+                self._update_level()
+                self._condition.notify_all()
+
+    def add_disk_bytes(self, delta):
+        with self._condition:
+            self._disk_bytes = max(0, self._disk_bytes + delta)
+            self._update_level()
@@ -0,0 +1,61 @@
+# bench_startup.py
+#
+# Measure how long a fresh worker takes to import bot.py and run create_app().
+#
+#   python bench_startup.py --runs 10 --budget 1.0
+#
+# Each run is a new interpreter in a scratch directory. DATABASE_URL defaults to
+# a throwaway SQLite file; pass --check-schema / --warm to include those steps.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = """
+import time
+started = time.perf_counter()
+import bot
+bot.create_app()
+print(time.perf_counter() - started)
+"""
+
+
+def run_once(workdir, env):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], cwd=workdir, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot.py cold start.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=1.0, help="max allowed median in seconds")
+    parser.add_argument('--check-schema', action='store_true')
+    parser.add_argument('--warm', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [BOT_DIR, env.get('PYTHONPATH')]))
+        env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+        env['CHECK_SCHEMA'] = 'true' if args.check_schema else 'false'
+        env['WARM_UP'] = 'true' if args.warm else 'false'
+
+        timings = [run_once(workdir, env) for _ in range(args.runs)]
+
+    median = statistics.median(timings)
+    print(f"runs={len(timings)} min={min(timings):.3f}s median={median:.3f}s max={max(timings):.3f}s")
+    if median > args.budget:
+        print(f"Median start-up time exceeds the {args.budget:.2f}s budget.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,27 @@
 import asyncio
+import atexit
 import json
 import logging
 import os
 import re
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from logging.handlers import TimedRotatingFileHandler
 
-import aiohttp
-import pytz
 import requests
-import json
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
-from pydub import AudioSegment
 from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, ForeignKey, text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from script import send_audio_to_api
+from admission import AdmissionController, Overloaded
+from resilience import RetryQueue
+from replay import WebhookRecorder
+from transcript_writer import TranscriptWriter
+from media_retention import LocalArchive, MediaCompactor, S3Archive, is_audio, restore
+from responses import ResponseCatalog, text_message_payload
+from script import send_audio_to_api, TranscriptionRejected, TranscriptionUnavailable, warm_up as warm_up_transcription
 
 
 app = Flask(__name__)
@@ -27,40 +32,76 @@ ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 VERSION = os.getenv("VERSION")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com")
 AUTH_PASSWORD = os.getenv("AUTH_PASSWORD")
 DATABASE_URL = os.getenv("DATABASE_URL")
-
-# Ensure necessary directories exist
-os.makedirs("logs", exist_ok=True)
-os.makedirs("media", exist_ok=True)
-os.makedirs("messages", exist_ok=True)
-
-# Load json bot responses
-with open('bot_responses.json', 'r', encoding='utf-8') as f:
-    MESSAGES = json.load(f)
+TRANSCRIPTION_RETRY_DELAY = float(os.getenv("TRANSCRIPTION_RETRY_DELAY", "30"))
+TRANSCRIPTION_RETRY_MAX_ATTEMPTS = int(os.getenv("TRANSCRIPTION_RETRY_MAX_ATTEMPTS", "10"))
+# Admission control (0 = unlimited)
+MAX_INFLIGHT_DOWNLOADS = int(os.getenv("MAX_INFLIGHT_DOWNLOADS", "8"))
+MAX_INFLIGHT_CONVERSIONS = int(os.getenv("MAX_INFLIGHT_CONVERSIONS", "4"))
+MAX_INFLIGHT_TRANSCRIPTIONS = int(os.getenv("MAX_INFLIGHT_TRANSCRIPTIONS", "4"))
+MAX_MEDIA_BYTES = int(os.getenv("MAX_MEDIA_BYTES", "0"))
+MEDIA_RESCAN_INTERVAL = float(os.getenv("MEDIA_RESCAN_INTERVAL", "60"))
+DEFERRED_MEDIA_DELAY = float(os.getenv("DEFERRED_MEDIA_DELAY", "30"))
+# Seconds the webhook waits for a free slot before deferring (the deferred queue's worker waits longer)
+WEBHOOK_SLOT_WAIT = float(os.getenv("WEBHOOK_SLOT_WAIT", "0"))
+DEFERRED_MEDIA_MAX_ATTEMPTS = int(os.getenv("DEFERRED_MEDIA_MAX_ATTEMPTS", "20"))
+# A worker owns a deferred job for this long while processing it
+DEFERRED_MEDIA_LEASE = float(os.getenv("DEFERRED_MEDIA_LEASE", "600"))
+# Text transcripts in messages/: 'text' (per user, per day) or 'jsonl' (one indexed log per day)
+MESSAGES_FORMAT = os.getenv("MESSAGES_FORMAT", "text")
+MESSAGES_FLUSH_BYTES = int(os.getenv("MESSAGES_FLUSH_BYTES", "65536"))
+MESSAGES_FLUSH_INTERVAL = float(os.getenv("MESSAGES_FLUSH_INTERVAL", "5"))
+MESSAGES_COMPRESS = os.getenv("MESSAGES_COMPRESS", "true").lower() == "true"
+# Record raw webhook bodies for replay.py (unset = off)
+WEBHOOK_CAPTURE_PATH = os.getenv("WEBHOOK_CAPTURE_PATH")
+# Startup: test the DB connection and create missing tables, pre-open connections
+CHECK_SCHEMA = os.getenv("CHECK_SCHEMA", "true").lower() == "true"
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+DB_WARM_CONNECTIONS = int(os.getenv("DB_WARM_CONNECTIONS", "2"))
+SQL_ECHO = os.getenv("SQL_ECHO", "true").lower() == "true"
+# Bot replies: check bot_responses.json for changes every N seconds (0 = off)
+RESPONSES_RELOAD_INTERVAL = float(os.getenv("RESPONSES_RELOAD_INTERVAL", "0"))
+# Media retention: recompress old WAV, move old files to an archive tier (0 = off)
+MEDIA_COMPACTION_INTERVAL = float(os.getenv("MEDIA_COMPACTION_INTERVAL", "0"))
+RECOMPRESS_AFTER_DAYS = float(os.getenv("RECOMPRESS_AFTER_DAYS", "7"))
+RECOMPRESS_CODEC = os.getenv("RECOMPRESS_CODEC", "flac")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_BACKEND = os.getenv("ARCHIVE_BACKEND", "local")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_S3_BUCKET = os.getenv("ARCHIVE_S3_BUCKET")
+ARCHIVE_S3_ENDPOINT = os.getenv("ARCHIVE_S3_ENDPOINT")
+RESTORE_DIR = os.getenv("RESTORE_DIR", "restored")
 
 # Configure logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-handler = TimedRotatingFileHandler(
-    filename='logs/bot.log',
-    when='H',
-    interval=1,
-    backupCount=24
-)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
 # Global dictionary to store user authentication status
 user_sessions = {}
+# Guards confirmation state (awaiting_confirmation, awaiting_correction, detection, result_id,
+# pending_confirmations), which the retry threads also update
+confirmation_lock = threading.Lock()
 # Media sequence
 media_sequence = {}
 
-# SQLAlchemy setup
-engine = create_engine(DATABASE_URL, echo=True)
-SessionLocal = sessionmaker(bind=engine)
+# Set up by create_app()
+setup_lock = threading.Lock()
+setup_done = False
+log_handler = None
+engine = None
+SessionLocal = sessionmaker()
+admission = None
+transcript_writer = None
+webhook_recorder = None
+responses = None
+media_archive = None
+media_compactor = None
+
+# Shared connection pool for Graph API calls
+http = requests.Session()
+
 Base = declarative_base()
 
 
@@ -83,7 +124,7 @@ class Message(Base):
     name = Column(String, nullable=True)
     message_text = Column(Text, nullable=True)
     hasAttachments = Column(Boolean, default=False)
-    attachment_links = Column(Text, nullable=True)  # Comma-separated links
+    attachment_links = Column(Text, nullable=True, index=True)  # Comma-separated links
     date_time = Column(DateTime, nullable=True)
     detected_audio = Column(String, nullable=True)
     rut_type = Column(String, nullable=True)
@@ -101,13 +142,43 @@ class Result(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     message_id = Column(Integer, ForeignKey('messages.id'))
-    audio_file_path = Column(String, nullable=False)
+    audio_file_path = Column(String, nullable=False, index=True)
     audio_file_name = Column(String, nullable=False)
     models_output = Column(Text, nullable=True)
     corrected = Column(Boolean, default=False)
     human_output = Column(Text, nullable=True)
 
     message = relationship("Message", back_populates="result")
+    failure = relationship("TranscriptionFailure", uselist=False, back_populates="result")
+
+
+class TranscriptionFailure(Base):
+    """A result that will never get a model transcription, so it isn't requeued."""
+    __tablename__ = 'transcription_failures'
+
+    result_id = Column(Integer, ForeignKey('results.id'), primary_key=True)
+    reason = Column(String, nullable=False)  # 'rejected' by the API or 'gave_up' after the last retry
+    date_time = Column(DateTime, nullable=False)
+
+    result = relationship("Result", back_populates="failure")
+
+
+class DeferredJob(Base):
+    __tablename__ = 'deferred_jobs'
+
+    id = Column(Integer, primary_key=True, index=True)
+    media_id = Column(String, nullable=False)
+    message_type = Column(String, nullable=False)
+    phone_num = Column(String, nullable=False)
+    date_time = Column(DateTime, nullable=False)
+    language = Column(String, nullable=True)
+    claimed_until = Column(DateTime, nullable=True)  # Set while a worker is processing the job
+
+
+# Servers that import `bot:app` directly (gunicorn bot:app, flask run) get set up on the first request
+@app.before_request
+def ensure_setup():
+    create_app()
 
 
 # To verify webhooks
@@ -119,6 +190,17 @@ def webhook():
         return handle_message()
 
 
+# Current pipeline pressure, for capacity tuning
+@app.route('/pressure', methods=['GET'])
+def pressure():
+    snapshot = admission.snapshot()
+    snapshot['queues'] = {
+        'deferred_media': len(deferred_media_queue),
+        'transcription_retries': len(transcription_retry_queue),
+    }
+    return jsonify(snapshot), 200
+
+
 # Use token in WA API to verify webhook
 def verify_webhook():
     token = request.args.get('hub.verify_token')
@@ -135,7 +217,6 @@ def verify_webhook():
 # Test connection to DB
 def test_connection():
     try:
-        engine = create_engine(DATABASE_URL)
         with engine.connect() as connection:
             result = connection.execute(text("SELECT 1"))
             fetched = result.fetchone()
@@ -147,9 +228,153 @@ def test_connection():
 # Create tables if needed
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    # create_all doesn't add new indexes to tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
     print("Tables created successfully")
 
 
+def warm_up():
+    """Open DB pool and HTTP connections so the first requests don't pay for them."""
+    connections = []
+    try:
+        for _ in range(DB_WARM_CONNECTIONS):
+            connection = engine.connect()
+            connection.execute(text("SELECT 1"))
+            connections.append(connection)
+    except SQLAlchemyError as e:
+        logger.error(f"DB warm-up failed: {e}")
+    finally:
+        # Closing returns the connections to the pool
+        for connection in connections:
+            connection.close()
+
+    try:
+        http.head(GRAPH_API_URL, timeout=5)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Graph API warm-up failed: {e}")
+    warm_up_transcription()
+    logger.info("Warm-up finished.")
+
+
+def create_app(check_schema=CHECK_SCHEMA, warm=WARM_UP, requeue=True):
+    """Set up the bot once per process and return the Flask app.
+
+    Heavy work happens here rather than at import: directories, logging, the
+    shared engine and the background writers. `check_schema` tests the DB
+    connection and creates missing tables; `warm` runs warm_up(); `requeue`
+    picks up transcriptions and deferred media left over from earlier runs.
+    Safe to call more than once and from several threads.
+    """
+    if not setup_done:
+        with setup_lock:
+            if not setup_done:
+                setup(check_schema, warm, requeue)
+    return app
+
+
+def setup(check_schema, warm, requeue):
+    # Each step is skipped if it's already done, so a retry after a failed setup doesn't repeat it
+    global setup_done, log_handler, engine, admission, transcript_writer, webhook_recorder, responses, \
+        media_archive, media_compactor
+
+    # Ensure necessary directories exist
+    os.makedirs("logs", exist_ok=True)
+    os.makedirs("media", exist_ok=True)
+    os.makedirs("messages", exist_ok=True)
+
+    if log_handler is None:
+        log_handler = TimedRotatingFileHandler(
+            filename='logs/bot.log',
+            when='H',
+            interval=1,
+            backupCount=24
+        )
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M')
+        log_handler.setFormatter(formatter)
+        logger.addHandler(log_handler)
+
+    # Compile json bot responses
+    if responses is None:
+        responses = ResponseCatalog(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_responses.json'),
+            reload_interval=RESPONSES_RELOAD_INTERVAL
+        )
+
+    # SQLAlchemy setup: one engine shared by the whole process
+    if engine is None:
+        engine = create_engine(DATABASE_URL, echo=SQL_ECHO)
+        SessionLocal.configure(bind=engine)
+
+    # Bound in-flight work per pipeline stage and the size of media/
+    if admission is None:
+        admission = AdmissionController(
+            {
+                'downloads': MAX_INFLIGHT_DOWNLOADS,
+                'conversions': MAX_INFLIGHT_CONVERSIONS,
+                'transcriptions': MAX_INFLIGHT_TRANSCRIPTIONS,
+            },
+            max_disk_bytes=MAX_MEDIA_BYTES,
+            media_dir="media",
+            retry_after=DEFERRED_MEDIA_DELAY,
+            disk_rescan_interval=MEDIA_RESCAN_INTERVAL
+        )
+
+    # Buffered writer for text transcripts, flushed in the background
+    if transcript_writer is None:
+        transcript_writer = TranscriptWriter(
+            "messages",
+            fmt=MESSAGES_FORMAT,
+            flush_bytes=MESSAGES_FLUSH_BYTES,
+            flush_interval=MESSAGES_FLUSH_INTERVAL,
+            compress=MESSAGES_COMPRESS
+        )
+        atexit.register(transcript_writer.close)
+
+    if WEBHOOK_CAPTURE_PATH and webhook_recorder is None:
+        webhook_recorder = WebhookRecorder(WEBHOOK_CAPTURE_PATH)
+        atexit.register(webhook_recorder.close)
+
+    # Tiered retention for media/
+    if media_archive is None:
+        if ARCHIVE_BACKEND == 's3':
+            media_archive = S3Archive(ARCHIVE_S3_BUCKET, endpoint_url=ARCHIVE_S3_ENDPOINT)
+        else:
+            media_archive = LocalArchive(ARCHIVE_DIR)
+    if media_compactor is None:
+        media_compactor = MediaCompactor(
+            "media",
+            relocate_media,
+            recompress_after_days=RECOMPRESS_AFTER_DAYS,
+            codec=RECOMPRESS_CODEC,
+            archive=media_archive,
+            archive_after_days=ARCHIVE_AFTER_DAYS,
+            restore_dir=RESTORE_DIR
+        )
+        if MEDIA_COMPACTION_INTERVAL:
+            media_compactor.start(
+                MEDIA_COMPACTION_INTERVAL,
+                on_pass=lambda stats: admission.add_disk_bytes(-stats['bytes_freed'])
+            )
+
+    if check_schema:
+        test_connection()
+        create_tables()
+    if requeue:
+        requeue_pending_transcriptions()
+        requeue_deferred_media()
+    if warm:
+        warm_up()
+    setup_done = True
+
+
+@lru_cache(maxsize=None)
+def local_timezone():
+    import pytz
+    return pytz.timezone('Asia/Yekaterinburg')  # Replace with the appropriate time zone
+
+
 # Main functionality
 def handle_message():
     messages = []
@@ -157,6 +382,8 @@ def handle_message():
     has_attachments = False
     attachment_links = []
 
+    if webhook_recorder:
+        webhook_recorder.record(request.get_data())
     data = request.get_json()
     logger.debug(f"Received data: {json.dumps(data)}")
 
@@ -174,10 +401,9 @@ def handle_message():
         for message in messages:
             # Timezone
             from_number = message.get('from')
-            timestamp = datetime.fromtimestamp(int(message.get('timestamp')), pytz.utc)
+            timestamp = datetime.fromtimestamp(int(message.get('timestamp')), timezone.utc)
             # Convert to UTC+5
-            utc_plus_5 = pytz.timezone('Asia/Yekaterinburg')  # Replace with the appropriate time zone
-            timestamp = timestamp.astimezone(utc_plus_5)
+            timestamp = timestamp.astimezone(local_timezone())
             # Make the datetime naive by removing the tzinfo
             timestamp_naive = timestamp.replace(tzinfo=None)
             formatted_time = timestamp_naive.strftime('%Y-%m-%d %H:%M:%S')
@@ -193,7 +419,8 @@ def handle_message():
                     'detection': '',
                     'result_id': None,
                     'language': None,
-                    'awaiting_language_selection': False
+                    'awaiting_language_selection': False,
+                    'pending_confirmations': []
                 }
 
             is_authenticated = user_sessions[from_number]['authenticated']
@@ -234,19 +461,16 @@ def handle_message():
                 if entered_password == AUTH_PASSWORD:
                     user_sessions[from_number]['authenticated'] = True
                     user_sessions[from_number]['awaiting_password'] = False
-                    success_message = get_message_text('authentication_success', language)
-                    asyncio.run(send_text_message(from_number, success_message))
+                    asyncio.run(send_reply(from_number, 'authentication_success', language))
                 else:
                     user_sessions[from_number]['authenticated'] = False
                     user_sessions[from_number]['awaiting_password'] = False
-                    failure_message = get_message_text('incorrect_code', language)
-                    asyncio.run(send_text_message(from_number, failure_message))
+                    asyncio.run(send_reply(from_number, 'incorrect_code', language))
                 return jsonify({"status": "authentication_attempted"}), 200
 
             if not is_authenticated and not awaiting_password:
                 logger.info(f"User {from_number} is not authenticated. Prompting to register.")
-                auth_required_msg = get_message_text('authentication_required', language)
-                asyncio.run(send_text_message(from_number, auth_required_msg))
+                asyncio.run(send_reply(from_number, 'authentication_required', language))
                 return jsonify({"status": "not_authenticated"}), 200
 
             # Confirmation for our model to re-train it back again
@@ -258,23 +482,18 @@ def handle_message():
                 negative = ['жоқ'] if language == 'kk' else ['нет']
 
                 if user_response in affirmative:
-                    confirmation_message = get_message_text('confirmation_thanks', language)
-                    asyncio.run(send_text_message(from_number, confirmation_message))
+                    asyncio.run(send_reply(from_number, 'confirmation_thanks', language))
                     # Update the Result record
                     update_result(session, result_id, corrected=False)
-                    # Reset the session state
-                    user_sessions[from_number]['awaiting_confirmation'] = False
-                    user_sessions[from_number]['detection'] = ''
-                    user_sessions[from_number]['result_id'] = None
+                    finish_confirmation(from_number)
                 elif user_response in negative:
-                    correction_prompt = get_message_text('correction_prompt', language)
-                    asyncio.run(send_text_message(from_number, correction_prompt))
+                    asyncio.run(send_reply(from_number, 'correction_prompt', language))
                     # Update session to expect corrected text
-                    user_sessions[from_number]['awaiting_correction'] = True
-                    user_sessions[from_number]['awaiting_confirmation'] = False
+                    with confirmation_lock:
+                        user_sessions[from_number]['awaiting_correction'] = True
+                        user_sessions[from_number]['awaiting_confirmation'] = False
                 else:
-                    retry_message = get_message_text('confirmation_retry', language)
-                    asyncio.run(send_text_message(from_number, retry_message))
+                    asyncio.run(send_reply(from_number, 'confirmation_retry', language))
                 return jsonify({"status": "confirmation_received"}), 200
 
             if message_type == 'text' and user_sessions[from_number].get('awaiting_correction'):
@@ -282,11 +501,8 @@ def handle_message():
                 result_id = user_sessions[from_number]['result_id']
                 # Update the Result record
                 update_result(session, result_id, corrected=True, human_output=corrected_text)
-                correction_thanks = get_message_text('correction_thanks', language)
-                asyncio.run(send_text_message(from_number, correction_thanks))
-                user_sessions[from_number]['awaiting_correction'] = False
-                user_sessions[from_number]['detection'] = ''
-                user_sessions[from_number]['result_id'] = None
+                asyncio.run(send_reply(from_number, 'correction_thanks', language))
+                finish_confirmation(from_number)
                 return jsonify({"status": "correction_received"}), 200
 
             #  For text messages:
@@ -301,70 +517,26 @@ def handle_message():
                     attachment_links='',
                     date_time=timestamp
                 )
-                await_response = get_message_text('text_received', language).format(text=text)
-                asyncio.run(save_message(from_number, text, formatted_time))
-                asyncio.run(send_text_message(from_number, await_response))
+                save_message(from_number, text, formatted_time)
+                asyncio.run(send_reply(from_number, 'text_received', language, text=text))
             # For audio files:
-            elif message_type in ['audio', 'voice']:
-                media_id = message[message_type]['id']
-                media_url = get_media_url(media_id)
-                filepath, filename, success = download_media(media_url, message_type, from_number, timestamp)
-                if success:
-                    has_attachments = True
-                    attachment_links = filepath
-                    detection = send_audio_to_api(filepath)
-
-                    message_entry = save_message_to_db(
-                        session=session,
-                        phone_num=from_number,
-                        message_text='',
-                        has_attachments=True,
-                        attachment_links=filepath,
-                        date_time=timestamp,
-                        detected_audio=detection
-                    )
-
-                    if message_entry:
-                        result_entry = Result(
-                            message_id=message_entry.id,
-                            audio_file_path=filepath,
-                            audio_file_name=filename,
-                            models_output=detection,
-                            corrected=False,
-                            human_output=None
-                        )
-                        session.add(result_entry)
-                        session.commit()
-
-                        asyncio.run(ask_user_for_confirmation(from_number, detection, result_entry.id))
-                    else:
-                        logger.error("Failed to save message to database.")
-                else:
-                    error_message = get_message_text('media_save_error', language)
-                    asyncio.run(send_async_message_status(from_number, filepath, success, message_type))
-
-
-            elif message_type in ['image', 'video', 'document']:
-                media_id = message[message_type]['id']
-                media_url = get_media_url(media_id)
-                filepath, filename, success = download_media(media_url, message_type, from_number, timestamp)
-                if success:
-                    has_attachments = True
-                    attachment_links = filepath  # Modify if handling multiple attachments
-                    # Save to database
-                    save_message_to_db(
-                        session=session,
-                        phone_num=from_number,
-                        message_text='',
-                        has_attachments=True,
-                        attachment_links=filepath,
-                        date_time=timestamp
-                    )
-                    media_saved_message = get_message_text('media_saved', language).format(filepath=filepath)
-                    asyncio.run(send_text_message(from_number, media_saved_message))
+            elif message_type in ['audio', 'voice', 'image', 'video', 'document']:
+                job = {
+                    'media_id': message[message_type]['id'],
+                    'message_type': message_type,
+                    'from_number': from_number,
+                    'timestamp': timestamp,
+                    'language': language
+                }
+                # Shed media work when the pipeline is saturated; text and auth stay fast
+                if admission.saturated(media_stages(message_type)):
+                    defer_media_job(job)
                 else:
-                    error_message = get_message_text('media_save_error', language)
-                    asyncio.run(send_text_message(from_number, error_message))
+                    try:
+                        process_media_job(session, job, slot_wait=WEBHOOK_SLOT_WAIT)
+                    except Overloaded as e:
+                        logger.warning(f"Deferring {message_type} from {from_number}: {e}")
+                        defer_media_job(job, e.retry_after)
 
             else:
                 logger.info(f"Received {message_type} message from {from_number}")
@@ -386,10 +558,367 @@ def handle_message():
         session.close()  # TO-DO: discover why we need close user sessions
 
 
+def media_stages(message_type):
+    if message_type in ['audio', 'voice']:
+        return ['downloads', 'conversions', 'transcriptions']
+    return ['downloads']
+
+
+def defer_media_job(job, retry_after=None):
+    """Store a media message for later, queue it and tell the user we'll reply shortly."""
+    session = SessionLocal()
+    try:
+        deferred_job = DeferredJob(
+            media_id=job['media_id'],
+            message_type=job['message_type'],
+            phone_num=job['from_number'],
+            date_time=job['timestamp'].replace(tzinfo=None),
+            language=job['language']
+        )
+        session.add(deferred_job)
+        session.commit()
+        job['job_id'] = deferred_job.id
+    except SQLAlchemyError as e:
+        # Still handled by this process, just not across a restart
+        logger.error(f"Error storing deferred {job['message_type']} from {job['from_number']}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+    deferred_media_queue.put(job, delay=retry_after or DEFERRED_MEDIA_DELAY)
+    asyncio.run(send_reply(job['from_number'], 'media_deferred', job['language']))
+
+
+def claim_deferred_job(job_id):
+    """Take the lease on a stored job; False if it's done or another worker holds it."""
+    now = datetime.utcnow()
+    session = SessionLocal()
+    try:
+        claimed = session.query(DeferredJob).filter(
+            DeferredJob.id == job_id,
+            (DeferredJob.claimed_until.is_(None)) | (DeferredJob.claimed_until < now)
+        ).update({'claimed_until': now + timedelta(seconds=DEFERRED_MEDIA_LEASE)}, synchronize_session=False)
+        session.commit()
+        return claimed == 1
+    finally:
+        session.close()
+
+
+def finish_deferred_job(job_id, done):
+    """Delete a stored job once it's done or given up, otherwise release its lease."""
+    session = SessionLocal()
+    try:
+        query = session.query(DeferredJob).filter_by(id=job_id)
+        if done:
+            query.delete(synchronize_session=False)
+        else:
+            query.update({'claimed_until': None}, synchronize_session=False)
+        session.commit()
+    except SQLAlchemyError as e:
+        logger.error(f"Error updating deferred job {job_id}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def requeue_deferred_media():
+    """Queue the deferred media jobs stored by earlier runs."""
+    session = SessionLocal()
+    try:
+        deferred_jobs = session.query(DeferredJob).all()
+        for deferred_job in deferred_jobs:
+            deferred_media_queue.put({
+                'job_id': deferred_job.id,
+                'media_id': deferred_job.media_id,
+                'message_type': deferred_job.message_type,
+                'from_number': deferred_job.phone_num,
+                'timestamp': deferred_job.date_time,
+                'language': deferred_job.language
+            }, delay=0)
+        logger.info(f"Requeued {len(deferred_jobs)} deferred media jobs.")
+    except SQLAlchemyError as e:
+        logger.error(f"Error requeuing deferred media jobs: {e}")
+    finally:
+        session.close()
+
+
+def process_media_job(session, job, slot_wait=None, on_saved=None):
+    """Download a media message, transcribe it if it's audio, and reply to the user.
+
+    Raises Overloaded if a download or conversion slot doesn't free up within
+    `slot_wait` seconds (default: the admission controller's `slot_wait`).
+    `on_saved()` is called once the message is committed, before any reply.
+    """
+    from_number = job['from_number']
+    message_type = job['message_type']
+    timestamp = job['timestamp']
+    language = job['language']
+
+    with admission.slot('downloads', slot_wait):
+        media_url = get_media_url(job['media_id'])
+        filepath, filename, success = download_media(media_url, message_type, from_number, timestamp, slot_wait)
+
+    if message_type in ['audio', 'voice']:
+        if success:
+            deferred = False
+            rejected = False
+            retry_after = None
+            try:
+                detection = transcribe(filepath, slot_wait)
+            except (TranscriptionUnavailable, Overloaded) as e:
+                logger.warning(f"Transcription of {filepath} deferred: {e}")
+                detection = None
+                deferred = True
+                retry_after = e.retry_after
+            except TranscriptionRejected as e:
+                logger.error(str(e))
+                detection = None
+                rejected = True
+
+            message_entry = save_message_to_db(
+                session=session,
+                phone_num=from_number,
+                message_text='',
+                has_attachments=True,
+                attachment_links=filepath,
+                date_time=timestamp,
+                detected_audio=detection
+            )
+
+            if message_entry:
+                result_entry = Result(
+                    message_id=message_entry.id,
+                    audio_file_path=filepath,
+                    audio_file_name=filename,
+                    models_output=detection,
+                    corrected=False,
+                    human_output=None
+                )
+                session.add(result_entry)
+                if rejected:
+                    session.flush()
+                    session.add(TranscriptionFailure(
+                        result_id=result_entry.id, reason='rejected', date_time=datetime.utcnow()
+                    ))
+                session.commit()
+                if on_saved:
+                    on_saved()
+
+                if deferred:
+                    transcription_retry_queue.put({
+                        'result_id': result_entry.id,
+                        'audio_path': filepath,
+                        'from_number': from_number
+                    }, delay=retry_after or TRANSCRIPTION_RETRY_DELAY)
+                    asyncio.run(send_reply(from_number, 'transcription_pending', language))
+                elif rejected:
+                    asyncio.run(send_reply(from_number, 'transcription_failed', language))
+                else:
+                    request_confirmation(from_number, detection, result_entry.id)
+            else:
+                logger.error("Failed to save message to database.")
+        else:
+            asyncio.run(send_async_message_status(from_number, filepath, success, message_type))
+
+    else:
+        if success:
+            # Save to database
+            save_message_to_db(
+                session=session,
+                phone_num=from_number,
+                message_text='',
+                has_attachments=True,
+                attachment_links=filepath,  # Modify if handling multiple attachments
+                date_time=timestamp
+            )
+            if on_saved:
+                on_saved()
+            asyncio.run(send_reply(from_number, 'media_saved', language, filepath=filepath))
+        else:
+            asyncio.run(send_reply(from_number, 'media_save_error', language))
+
+
+def process_deferred_media(job):
+    admission.check(media_stages(job['message_type']))
+    job_id = job.get('job_id')
+    if job_id is not None and not claim_deferred_job(job_id):
+        logger.info(f"Deferred job {job_id} is done or taken by another worker.")
+        return
+
+    saved = False
+
+    def mark_saved():
+        nonlocal saved
+        saved = True
+        if job_id is not None:
+            finish_deferred_job(job_id, done=True)
+
+    session = SessionLocal()
+    try:
+        process_media_job(session, job, on_saved=mark_saved)
+    except Exception as e:
+        if saved:
+            # The message is stored; retrying would download and save it again
+            logger.error(f"Failed to reply to deferred {job['message_type']} from {job['from_number']}: {e}")
+            return
+        if job_id is not None:
+            finish_deferred_job(job_id, done=False)
+        raise
+    finally:
+        session.close()
+    if job_id is not None and not saved:
+        finish_deferred_job(job_id, done=True)
+
+
+def give_up_deferred_media(job, error):
+    """Drop a deferred job for good and let the user know, since we promised a reply."""
+    if job.get('job_id') is not None:
+        finish_deferred_job(job['job_id'], done=True)
+    asyncio.run(send_reply(job['from_number'], 'media_failed', job['language']))
+
+
+deferred_media_queue = RetryQueue(
+    process_deferred_media,
+    base_delay=DEFERRED_MEDIA_DELAY,
+    max_attempts=DEFERRED_MEDIA_MAX_ATTEMPTS,
+    on_give_up=give_up_deferred_media
+)
+
+
+def transcribe(filepath, slot_wait=None):
+    with admission.slot('transcriptions', slot_wait):
+        return send_audio_to_api(filepath)
+
+
+def retry_transcription(job):
+    """Re-run a deferred transcription and ask the user to confirm it once it arrives."""
+    session = SessionLocal()
+    try:
+        result_entry = session.query(Result).filter_by(id=job['result_id']).first()
+        if not result_entry:
+            logger.warning(f"No result entry found with id: {job['result_id']}")
+            return
+        if result_entry.models_output is not None:
+            # Every worker requeues pending results at startup; another one got here first
+            logger.info(f"Result {job['result_id']} is already transcribed.")
+            return
+        # The file may have been recompressed or archived since the job was queued
+        audio_path = result_entry.audio_file_path
+    finally:
+        session.close()
+
+    detection = transcribe(load_media(audio_path, as_wav=True))
+
+    session = SessionLocal()
+    try:
+        result_entry = session.query(Result).filter_by(id=job['result_id']).first()
+        if not result_entry:
+            # Deleted while the audio was being transcribed
+            logger.warning(f"No result entry found with id: {job['result_id']}")
+            return
+        result_entry.models_output = detection
+        if result_entry.message:
+            result_entry.message.detected_audio = detection
+        session.commit()
+        logger.info(f"Stored deferred transcription for result {job['result_id']}.")
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    request_confirmation(job['from_number'], detection, job['result_id'])
+
+
+def give_up_transcription(job, error):
+    """Record a transcription that won't arrive and tell the user, who was promised the result."""
+    session = SessionLocal()
+    try:
+        if session.get(TranscriptionFailure, job['result_id']) is None:
+            session.add(TranscriptionFailure(
+                result_id=job['result_id'],
+                reason='rejected' if isinstance(error, TranscriptionRejected) else 'gave_up',
+                date_time=datetime.utcnow()
+            ))
+            session.commit()
+    except SQLAlchemyError as e:
+        logger.error(f"Error recording failed transcription for result {job['result_id']}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+    from_number = job['from_number']
+    if from_number:
+        language = user_sessions.get(from_number, {}).get('language')
+        asyncio.run(send_reply(from_number, 'transcription_failed', language))
+
+
+transcription_retry_queue = RetryQueue(
+    retry_transcription,
+    base_delay=TRANSCRIPTION_RETRY_DELAY,
+    max_attempts=TRANSCRIPTION_RETRY_MAX_ATTEMPTS,
+    on_give_up=give_up_transcription
+)
+
+
+def requeue_pending_transcriptions():
+    """Queue audio results that were left without a transcription (e.g. by a restart).
+
+    Results recorded in transcription_failures are left alone.
+    """
+    session = SessionLocal()
+    try:
+        pending = session.query(Result).outerjoin(TranscriptionFailure).filter(
+            Result.models_output.is_(None),
+            TranscriptionFailure.result_id.is_(None)
+        ).all()
+        pending = [result_entry for result_entry in pending if is_audio(result_entry.audio_file_path)]
+        for result_entry in pending:
+            transcription_retry_queue.put({
+                'result_id': result_entry.id,
+                'audio_path': result_entry.audio_file_path,
+                'from_number': result_entry.message.phone_num if result_entry.message else None
+            }, delay=0)
+        logger.info(f"Requeued {len(pending)} pending transcriptions.")
+    except SQLAlchemyError as e:
+        logger.error(f"Error requeuing pending transcriptions: {e}")
+    finally:
+        session.close()
+
+
+def load_media(path, as_wav=False):
+    """Local path for a stored media file, restoring it from the archive tier if needed."""
+    return restore(path, media_archive, RESTORE_DIR, as_wav=as_wav)
+
+
+def relocate_media(old_path, new_path):
+    """Point every result and message referencing `old_path` at `new_path`, in one transaction."""
+    session = SessionLocal()
+    try:
+        for result_entry in session.query(Result).filter_by(audio_file_path=old_path):
+            result_entry.audio_file_path = new_path
+            result_entry.audio_file_name = os.path.basename(new_path)
+        # Media messages store a single path; only scan for comma-separated lists if that finds nothing
+        message_entries = session.query(Message).filter(Message.attachment_links == old_path).all()
+        if not message_entries:
+            message_entries = session.query(Message).filter(
+                Message.attachment_links.contains(old_path, autoescape=True)
+            ).all()
+        for message_entry in message_entries:
+            links = message_entry.attachment_links.split(',')
+            message_entry.attachment_links = ','.join(new_path if link == old_path else link for link in links)
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
 def get_media_url(media_id):
-    url = f"https://graph.facebook.com/{VERSION}/{media_id}"
+    url = f"{GRAPH_API_URL}/{VERSION}/{media_id}"
     headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    response = requests.get(url, headers=headers).json()
+    response = http.get(url, headers=headers).json()
     return response.get('url')
 
 
@@ -408,9 +937,9 @@ def get_next_sequence_number(phone_dir, media_type):
         return 1
 
 
-def download_media(url, media_type, from_number, timestamp):
+def download_media(url, media_type, from_number, timestamp, slot_wait=None):
     headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    response = requests.get(url, headers=headers, stream=True)
+    response = http.get(url, headers=headers, stream=True)
 
     content_type = response.headers.get('Content-Type', '')
     logger.info(f"Content-Type: {content_type}")
@@ -469,24 +998,37 @@ def download_media(url, media_type, from_number, timestamp):
             for chunk in response.iter_content(1024):
                 f.write(chunk)
         logger.info(f"Media saved at: {original_filepath}")
+        original_size = os.path.getsize(original_filepath)
+        admission.add_disk_bytes(original_size)
         success = True
         # Convert every audio or voice to wav
-        if media_type in ['audio', 'voice'] and audio_format is not None:
+        # WAV needs no conversion; converting it in place would delete the file below
+        if media_type in ['audio', 'voice'] and audio_format not in (None, 'wav'):
             try:
-                audio = AudioSegment.from_file(original_filepath, format=audio_format)
+                from pydub import AudioSegment  # Imported on first use, it's slow to load
+
+                with admission.slot('conversions', slot_wait):
+                    audio = AudioSegment.from_file(original_filepath, format=audio_format)
 
-                wav_filename = f"{media_type}_{sequence_number}_{time_str}.wav"
-                wav_filepath = os.path.join(phone_dir, wav_filename)
+                    wav_filename = f"{media_type}_{sequence_number}_{time_str}.wav"
+                    wav_filepath = os.path.join(phone_dir, wav_filename)
 
-                audio.export(wav_filepath, format="wav", bitrate="192k")
+                    audio.export(wav_filepath, format="wav", bitrate="192k")
 
                 logger.info(f"Converted audio saved at: {wav_filepath}")
+                admission.add_disk_bytes(os.path.getsize(wav_filepath))
 
                 os.remove(original_filepath)
+                admission.add_disk_bytes(-original_size)
                 logger.info(f"Deleted original file: {original_filepath}")
 
                 return wav_filepath, wav_filename, True
 
+            except Overloaded:
+                # The job is deferred and downloaded again later
+                os.remove(original_filepath)
+                admission.add_disk_bytes(-original_size)
+                raise
             except Exception as e:
                 logger.error(f"Failed to convert audio to WAV: {e}")
                 return original_filepath, original_filename, False
@@ -494,6 +1036,8 @@ def download_media(url, media_type, from_number, timestamp):
         else:
             return original_filepath, original_filename, True
 
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"Failed to save media: {e}")
         success = False
@@ -501,7 +1045,9 @@ def download_media(url, media_type, from_number, timestamp):
         return original_filepath, original_filename, success
 
 
-def get_text_message_input(recipient, text):
+@lru_cache(maxsize=65536)
+def format_recipient(recipient):
+    """JSON-encoded WhatsApp recipient for a sender's number, computed once per number."""
     formatted_recipient = recipient.lstrip('+')
 
     if formatted_recipient.startswith('7'):
@@ -510,13 +1056,7 @@ def get_text_message_input(recipient, text):
         formatted_recipient = '78' + formatted_recipient
 
     logger.debug(f"Formatted recipient number: {formatted_recipient}")
-
-    return {
-        "messaging_product": "whatsapp",
-        "to": formatted_recipient,
-        "type": "text",
-        "text": {"body": text}
-    }
+    return json.dumps(formatted_recipient)
 
 
 def save_message_to_db(session, phone_num, message_text, has_attachments, attachment_links, date_time,
@@ -544,8 +1084,8 @@ def save_message_to_db(session, phone_num, message_text, has_attachments, attach
         return None
 
 
-def get_message_text(message_key, language):
-    return MESSAGES.get(message_key, {}).get(language, '')
+def get_message_text(message_key, language, **fields):
+    return responses.text(message_key, language, **fields)
 
 
 def update_result(session, result_id, corrected, human_output=None):
@@ -600,9 +1140,9 @@ def fetch_whatsapp_name(phone_num):
     else:
         phone_num_formatted = phone_num
 
-    url = f"https://graph.facebook.com/{VERSION}/{PHONE_NUMBER_ID}/contacts/{phone_num_formatted}"
+    url = f"{GRAPH_API_URL}/{VERSION}/{PHONE_NUMBER_ID}/contacts/{phone_num_formatted}"
     headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-    response = requests.get(url, headers=headers)
+    response = http.get(url, headers=headers)
 
     if response.status_code == 200:
         data = response.json()
@@ -636,15 +1176,17 @@ def insert_phone_number(phone_num: str, name: str, whatsapp_name: str):
 
 
 # Response message
-async def send_async_message(data):
+async def send_async_message(payload):
+    import aiohttp
+
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {ACCESS_TOKEN}",
     }
-    url = f"https://graph.facebook.com/{VERSION}/{PHONE_NUMBER_ID}/messages"
+    url = f"{GRAPH_API_URL}/{VERSION}/{PHONE_NUMBER_ID}/messages"
 
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=data, headers=headers) as response:
+        async with session.post(url, data=payload.encode('utf-8'), headers=headers) as response:
             response_text = await response.text()
             if response.status in [200, 201]:
                 logger.info("Async message sent successfully!")
@@ -655,69 +1197,76 @@ async def send_async_message(data):
 
 
 async def prompt_language_selection(from_number, invalid=False):
-    if invalid:
-        message_body = get_message_text('language_invalid', 'kk')
-    else:
-        message_body = get_message_text('language_prompt', 'kk')
-    await send_text_message(from_number, message_body)
+    await send_reply(from_number, 'language_invalid' if invalid else 'language_prompt', 'kk')
 
     user_sessions[from_number]['awaiting_language_selection'] = True
 
 
 async def send_authentication_prompt(from_number):
     language = user_sessions[from_number]['language']
-    message_body = get_message_text('authentication_prompt', language)
-    await send_text_message(from_number, message_body)
+    await send_reply(from_number, 'authentication_prompt', language)
     user_sessions[from_number]['awaiting_password'] = True
 
 
-async def ask_user_for_confirmation(from_number, detection, result_id):
-    language = user_sessions[from_number]['language']
-    if language == 'kk':
-        message_body = f"Біз танылдық: \"{detection}\". Бұл дұрыс па? 'Иә' немесе 'жоқ' деп жауап беріңіз."
-    elif language == 'ru':
-        message_body = f"Мы распознали: \"{detection}\". Это правильно? Пожалуйста, ответьте 'да' или 'нет'."
-    else:
-        message_body = f"Мы распознали: \"{detection}\". Это правильно? Пожалуйста, ответьте 'да' или 'нет'."
-    await send_text_message(from_number, message_body)
-    # Update user session to expect confirmation
-    user_sessions[from_number]['awaiting_confirmation'] = True
-    user_sessions[from_number]['detection'] = detection
-    user_sessions[from_number]['result_id'] = result_id
+def request_confirmation(from_number, detection, result_id):
+    """Ask the user to confirm a transcription, or queue it while they're answering another one.
 
+    Prompting right away would replace the result the user is confirming or
+    correcting, and their answer would be saved on the wrong result.
+    """
+    with confirmation_lock:
+        user_session = user_sessions.get(from_number)
+        if not user_session or not user_session['language']:
+            # The session lives in another worker or was lost in a restart; the result stays unconfirmed
+            logger.info(f"No session for {from_number}, not asking to confirm result {result_id}.")
+            return
+        if user_session['awaiting_confirmation'] or user_session['awaiting_correction']:
+            user_session['pending_confirmations'].append((detection, result_id))
+            return
+        user_session['awaiting_confirmation'] = True
+        user_session['detection'] = detection
+        user_session['result_id'] = result_id
+    asyncio.run(ask_user_for_confirmation(from_number, detection))
+
+
+def finish_confirmation(from_number):
+    """Reset the session once a transcription is confirmed or corrected, then ask about the next queued one."""
+    with confirmation_lock:
+        user_session = user_sessions[from_number]
+        user_session['awaiting_confirmation'] = False
+        user_session['awaiting_correction'] = False
+        user_session['detection'] = ''
+        user_session['result_id'] = None
+        if not user_session['pending_confirmations']:
+            return
+        detection, result_id = user_session['pending_confirmations'].pop(0)
+        user_session['awaiting_confirmation'] = True
+        user_session['detection'] = detection
+        user_session['result_id'] = result_id
+    asyncio.run(ask_user_for_confirmation(from_number, detection))
 
-async def send_async_message_status(from_number, filepath, success, message_type):
-    msg_type_forms = {
-        'text': 'текстовое сообщение',
-        'image': 'изображение',
-        'video': 'видео',
-        'audio': 'аудио',
-        'document': 'документ',
-        'voice': 'голосовое сообщение',
-        'others': 'другое сообщение',
-    }
 
-    if success:
-        message_body = f"Вы отправили :{msg_type_forms.get(message_type)}, успешно сохранено в {filepath}"
-    else:
-        message_body = f"Не удалось сохранить {msg_type_forms.get(message_type)}, попробуйте еще раз"
-    await send_text_message(from_number, message_body)
+async def ask_user_for_confirmation(from_number, detection):
+    language = user_sessions[from_number]['language']
+    await send_reply(from_number, 'confirmation_request', language, detection=detection)
 
-async def save_message(from_number, text, timestamp):
-    filename = f"{from_number}.txt"
-    filepath = os.path.join("messages", filename)
 
-    message_content = f"Timestamp: {timestamp}\nFrom: {from_number}\nMessage: {text}\n\n"
+async def send_async_message_status(from_number, filepath, success, message_type):
+    language = user_sessions.get(from_number, {}).get('language')
+    media_type = get_message_text(f"media_type_{message_type}", language)
+    status_key = 'media_status_saved' if success else 'media_status_failed'
+    await send_reply(from_number, status_key, language, media_type=media_type, filepath=filepath)
+
 
-    with open(filepath, "a", encoding="utf-8") as f:
-        f.write(message_content)
+def save_message(from_number, text, timestamp):
+    transcript_writer.write(from_number, text, timestamp)
 
 
-async def send_text_message(from_number, message_body):
-    data = get_text_message_input(from_number, message_body)
-    await send_async_message(data)
+async def send_reply(from_number, message_key, language, **fields):
+    """Send a catalog reply, reusing its pre-encoded JSON body when it has no fields."""
+    payload = text_message_payload(format_recipient(from_number), responses.body_json(message_key, language, **fields))
+    await send_async_message(payload)
 
 if __name__ == "__main__":
-    test_connection()
-    create_tables()
+    create_app()
     app.run(host='0.0.0.0', port=3000)
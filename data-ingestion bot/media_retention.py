@@ -0,0 +1,263 @@
+# media_retention.py
+#
+# Tiered retention for media/: old WAV voice notes are recompressed to FLAC or
+# Opus, and old files of any kind are moved to an archive tier (a local
+# directory or an S3-compatible bucket). Database references are updated
+# through a `relocate(old_path, new_path)` callback before the old file is
+# removed, and restore() brings archived audio back when it's needed again.
+#
+#   python media_retention.py      # run one compaction pass with the bot's settings
+
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {'.wav', '.flac', '.opus'}
+LOCK_FILE = '.compaction.lock'
+DAY = 24 * 60 * 60
+
+
+def is_audio(path):
+    return os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS
+
+
+# -------------------------------
+# Archive tiers
+# -------------------------------
+
+class LocalArchive:
+    """Archive tier in a local directory; archived paths stay plain file paths."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def store(self, path, key):
+        destination = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy2(path, destination)
+        return destination
+
+    def owns(self, path):
+        return False
+
+    def fetch(self, path, destination):
+        shutil.copy2(path, destination)
+
+
+class S3Archive:
+    """Archive tier in an S3-compatible bucket; archived paths look like s3://bucket/key."""
+
+    def __init__(self, bucket, endpoint_url=None, prefix=''):
+        import boto3  # Only needed for the S3 tier
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def store(self, path, key):
+        key = self.prefix + key.replace(os.sep, '/')
+        self._client.upload_file(path, self.bucket, key)
+        return f"s3://{self.bucket}/{key}"
+
+    def owns(self, path):
+        return path.startswith(f"s3://{self.bucket}/")
+
+    def fetch(self, path, destination):
+        key = path[len(f"s3://{self.bucket}/"):]
+        self._client.download_file(self.bucket, key, destination)
+
+
+# -------------------------------
+# Restore
+# -------------------------------
+
+def restore(path, archive=None, restore_dir='restored', as_wav=False):
+    """Return a local path for a stored media file, fetching it from the archive if needed.
+
+    With `as_wav`, recompressed audio is decoded back to WAV for the transcription API.
+    Restored copies live in `restore_dir` and are cleaned up by MediaCompactor.
+    """
+    local_path = path
+    relative_path = os.path.splitdrive(path)[1].lstrip(os.sep)
+    if archive is not None and archive.owns(path):
+        relative_path = path.split('://', 1)[1]
+        local_path = os.path.join(restore_dir, relative_path)
+        if not os.path.exists(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            archive.fetch(path, local_path)
+            logger.info(f"Restored {path} to {local_path}")
+
+    if as_wav and os.path.splitext(local_path)[1].lower() in ('.flac', '.opus'):
+        from pydub import AudioSegment
+
+        wav_path = os.path.join(restore_dir, os.path.splitext(relative_path)[0] + '.wav')
+        if not os.path.exists(wav_path):
+            os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+            AudioSegment.from_file(local_path).export(wav_path, format="wav")
+            logger.info(f"Decoded {local_path} to {wav_path}")
+        local_path = wav_path
+    return local_path
+
+
+# -------------------------------
+# Compaction
+# -------------------------------
+
+class MediaCompactor:
+    """Recompress and archive old files under `media_dir`.
+
+    WAV files older than `recompress_after_days` are re-encoded to `codec`
+    ('flac' or 'opus'); files older than `archive_after_days` go to `archive`.
+    0 disables a step. `relocate(old_path, new_path)` must update every
+    database reference in one transaction; the old file is only deleted after it
+    succeeds.
+    """
+
+    def __init__(self, media_dir, relocate, recompress_after_days=7, codec='flac', opus_bitrate='32k',
+                 archive=None, archive_after_days=0, restore_dir='restored', restore_ttl_days=1):
+        if codec not in ('flac', 'opus'):
+            raise ValueError(f"Unsupported codec: {codec}")
+        self.media_dir = media_dir
+        self.relocate = relocate
+        self.recompress_after_days = recompress_after_days
+        self.codec = codec
+        self.opus_bitrate = opus_bitrate
+        self.archive = archive
+        self.archive_after_days = archive_after_days if archive is not None else 0
+        self.restore_dir = restore_dir
+        self.restore_ttl_days = restore_ttl_days
+        self._thread = None
+
+    def start(self, interval, on_pass=None):
+        """Run a pass every `interval` seconds in a daemon thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    stats = self.run_once()
+                    if on_pass:
+                        on_pass(stats)
+                except Exception as e:
+                    logger.error(f"Media compaction failed: {e}")
+                    logger.debug("Exception info:", exc_info=True)
+
+        self._thread = threading.Thread(target=loop, name='media-compaction', daemon=True)
+        self._thread.start()
+
+    def run_once(self):
+        """Run one compaction pass and return counts and the bytes freed from media_dir."""
+        stats = {'recompressed': 0, 'archived': 0, 'bytes_freed': 0}
+        if not self._acquire_lock():
+            logger.info("Another compaction pass is running, skipping.")
+            return stats
+        try:
+            now = time.time()
+            for root, dirs, files in os.walk(self.media_dir):
+                dirs[:] = [name for name in dirs if not name.startswith('.')]
+                for name in files:
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        age_days = (now - os.path.getmtime(path)) / DAY
+                        self._compact_file(path, age_days, stats)
+                    except Exception as e:
+                        logger.error(f"Failed to compact {path}: {e}")
+            self._remove_empty_dirs(now)
+            self._expire_restored(now)
+        finally:
+            self._release_lock()
+        logger.info(f"Media compaction finished: {stats}")
+        return stats
+
+    def _compact_file(self, path, age_days, stats):
+        if (self.recompress_after_days and age_days >= self.recompress_after_days
+                and path.lower().endswith('.wav')):
+            size = os.path.getsize(path)
+            path = self._recompress(path)
+            stats['recompressed'] += 1
+            stats['bytes_freed'] += size - os.path.getsize(path)
+
+        if self.archive_after_days and age_days >= self.archive_after_days:
+            size = os.path.getsize(path)
+            key = os.path.relpath(path, self.media_dir)
+            archived_path = self.archive.store(path, key)
+            self.relocate(path, archived_path)
+            os.remove(path)
+            stats['archived'] += 1
+            stats['bytes_freed'] += size
+            logger.info(f"Archived {path} to {archived_path}")
+
+    def _recompress(self, path):
+        from pydub import AudioSegment
+
+        extension = '.flac' if self.codec == 'flac' else '.opus'
+        new_path = os.path.splitext(path)[0] + extension
+        audio = AudioSegment.from_file(path, format="wav")
+        if self.codec == 'flac':
+            audio.export(new_path, format="flac")
+        else:
+            audio.export(new_path, format="opus", bitrate=self.opus_bitrate)
+        # Keep the original age so the archive step still sees it as old
+        stat = os.stat(path)
+        os.utime(new_path, (stat.st_atime, stat.st_mtime))
+
+        try:
+            self.relocate(path, new_path)
+        except Exception:
+            os.remove(new_path)
+            raise
+        os.remove(path)
+        logger.info(f"Recompressed {path} to {new_path}")
+        return new_path
+
+    def _remove_empty_dirs(self, now):
+        for root, dirs, files in os.walk(self.media_dir, topdown=False):
+            # Leave recently created directories alone, a download may be about to use them
+            if root != self.media_dir and not os.listdir(root) and now - os.path.getmtime(root) >= DAY:
+                os.rmdir(root)
+
+    def _expire_restored(self, now):
+        if not os.path.isdir(self.restore_dir):
+            return
+        for root, _, files in os.walk(self.restore_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if (now - os.path.getmtime(path)) / DAY >= self.restore_ttl_days:
+                    os.remove(path)
+
+    def _acquire_lock(self):
+        # Several workers may share media/; only one of them compacts at a time
+        lock_path = os.path.join(self.media_dir, LOCK_FILE)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # A lock older than a day was left behind by a crashed pass
+            if time.time() - os.path.getmtime(lock_path) < DAY:
+                return False
+            os.remove(lock_path)
+            return self._acquire_lock()
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+
+    def _release_lock(self):
+        try:
+            os.remove(os.path.join(self.media_dir, LOCK_FILE))
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    import bot
+
+    bot.create_app(warm=False, requeue=False)
+    print(bot.media_compactor.run_once())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+# replay.py
+#
+# Record incoming webhook traffic and replay it against a local bot instance.
+#
+#   python replay.py stub --port 8081
+#       Stub Graph + transcription API. Start the bot with
+#       GRAPH_API_URL=http://localhost:8081 TRANSCRIPTION_API_URL=http://localhost:8081/transcribe
+#
+#   python replay.py run capture.jsonl.gz --url http://localhost:3000/webhook --speed 10 --password <AUTH_PASSWORD>
+#       Replay a capture at 10x (--speed 0 sends as fast as possible). Every sender is
+#       first taken through language selection and logged in, so the replay reaches the
+#       text and media pipeline instead of the login prompts; --no-seed skips that.
+
+import argparse
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+import wave
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Flask, request, jsonify
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------------------
+# Capture
+# -------------------------------
+
+class WebhookRecorder:
+    """Append raw webhook bodies and their arrival times to a gzipped JSONL file.
+
+    Records are written from a background thread so capturing doesn't slow down
+    the webhook.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='webhook-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, body, arrival=None):
+        with self._condition:
+            self._buffer.append({'t': arrival or time.time(), 'body': body.decode('utf-8', 'replace')})
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(self.flush_interval)
+                records, self._buffer = self._buffer, []
+                closed = self._closed
+            if records:
+                try:
+                    with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                        f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+                except OSError as e:
+                    logger.error(f"Failed to write {len(records)} captured webhooks: {e}")
+            if closed:
+                return
+
+
+def load_capture(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# -------------------------------
+# Stub Graph and transcription API
+# -------------------------------
+
+def silent_wav(seconds=1, rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b'\x00\x00' * rate * seconds)
+    return buffer.getvalue()
+
+
+def create_stub_app(delay=0.0):
+    """Flask app answering the Graph and transcription calls the bot makes."""
+    stub = Flask('replay_stub')
+    audio = silent_wav()
+
+    def pause():
+        if delay:
+            time.sleep(delay)
+
+    @stub.route('/<version>/<phone_number_id>/messages', methods=['POST'])
+    def send_message(version, phone_number_id):
+        pause()
+        return jsonify({"messages": [{"id": "stub"}]}), 200
+
+    @stub.route('/<version>/<phone_number_id>/contacts/<phone_num>', methods=['GET'])
+    def contact(version, phone_number_id, phone_num):
+        pause()
+        return jsonify({"profile": {"name": "Replay"}}), 200
+
+    @stub.route('/<version>/<media_id>', methods=['GET'])
+    def media_url(version, media_id):
+        pause()
+        return jsonify({"url": f"{request.host_url}media/{media_id}"}), 200
+
+    @stub.route('/media/<media_id>', methods=['GET'])
+    def media(media_id):
+        pause()
+        return audio, 200, {'Content-Type': 'audio/wav'}
+
+    @stub.route('/transcribe', methods=['POST'])
+    def transcribe():
+        pause()
+        return jsonify({"detection": "stub transcription"}), 200
+
+    return stub
+
+
+# -------------------------------
+# Replay
+# -------------------------------
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def capture_senders(records):
+    """Map each sender in `records` to the timestamp of their first message."""
+    senders = {}
+    for record in records:
+        try:
+            value = json.loads(record['body'])['entry'][0]['changes'][0]['value']
+        except (ValueError, KeyError, IndexError, TypeError):
+            continue
+        for message in value.get('messages', []):
+            if message.get('from'):
+                senders.setdefault(message['from'], message.get('timestamp', str(int(record['t']))))
+    return senders
+
+
+def text_webhook(from_number, text, timestamp):
+    message = {'from': from_number, 'timestamp': timestamp, 'type': 'text', 'text': {'body': text}}
+    return json.dumps({'entry': [{'changes': [{'value': {'messages': [message]}}]}]}, ensure_ascii=False)
+
+
+def seed_sessions(records, url, password, language='2', workers=16):
+    """Take every sender in `records` through language selection and log them in.
+
+    The bot keeps sessions in memory, so against a fresh instance every replayed
+    sender would otherwise only reach the language and password prompts. These
+    requests are sent before the replay and aren't part of its report. Returns
+    the number of senders.
+    """
+    steps = ['start', language, 'старт', password]
+    http = requests.Session()
+
+    def seed(sender):
+        from_number, timestamp = sender
+        for text in steps:
+            response = http.post(url, data=text_webhook(from_number, text, timestamp).encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'}, timeout=120)
+            response.raise_for_status()
+
+    senders = capture_senders(records)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(seed, senders.items()))
+    return len(senders)
+
+
+def replay(records, url, speed=1.0, workers=16):
+    """Send `records` to `url`, keeping their original spacing divided by `speed`.
+
+    `speed=0` sends them as fast as the workers allow. Returns a report with
+    latency percentiles (ms), measured from each request's scheduled send time,
+    and a count of outcomes per status code or error.
+    """
+    latencies = []
+    outcomes = Counter()
+    lock = threading.Lock()
+    http = requests.Session()
+
+    def send(body, scheduled):
+        try:
+            response = http.post(url, data=body.encode('utf-8'),
+                                 headers={'Content-Type': 'application/json'}, timeout=120)
+            outcome = str(response.status_code)
+            # The bot always answers 200; errors are reported in the body
+            if response.ok and response.headers.get('Content-Type', '').startswith('application/json'):
+                status = response.json().get('status')
+                if status == 'error':
+                    outcome = 'app_error'
+        except requests.exceptions.RequestException as e:
+            outcome = type(e).__name__
+        # Measured from when the request was due, so time spent queued for a worker counts too
+        elapsed = (time.perf_counter() - scheduled) * 1000
+        with lock:
+            latencies.append(elapsed)
+            outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    first_arrival = records[0]['t'] if records else 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for record in records:
+            scheduled = time.perf_counter()
+            if speed:
+                scheduled = started + (record['t'] - first_arrival) / speed
+                wait_for = scheduled - time.perf_counter()
+                if wait_for > 0:
+                    time.sleep(wait_for)
+            executor.submit(send, record['body'], scheduled)
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(records),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(records) / duration, 1) if duration else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 1),
+            'p90': round(percentile(latencies, 0.90), 1),
+            'p99': round(percentile(latencies, 0.99), 1),
+            'max': round(latencies[-1], 1) if latencies else 0.0,
+        },
+        'outcomes': dict(outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured webhook traffic against a local bot.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="replay a capture file")
+    run_parser.add_argument('capture', help="gzipped JSONL written with WEBHOOK_CAPTURE_PATH")
+    run_parser.add_argument('--url', default='http://localhost:3000/webhook')
+    run_parser.add_argument('--speed', type=float, default=1.0, help="time multiplier, 0 = as fast as possible")
+    run_parser.add_argument('--workers', type=int, default=16)
+    run_parser.add_argument('--language', default='2', help="language menu choice sent for every sender (1 = kk, 2 = ru)")
+    run_parser.add_argument('--password', help="the bot's AUTH_PASSWORD, used to log every sender in")
+    run_parser.add_argument('--no-seed', action='store_true', help="replay against whatever sessions the bot has")
+
+    stub_parser = subparsers.add_parser('stub', help="serve stub Graph and transcription endpoints")
+    stub_parser.add_argument('--port', type=int, default=8081)
+    stub_parser.add_argument('--delay', type=float, default=0.0, help="seconds added to every stub response")
+
+    args = parser.parse_args()
+    if args.command == 'stub':
+        create_stub_app(args.delay).run(host='127.0.0.1', port=args.port, threaded=True)
+    else:
+        if not args.no_seed and not args.password:
+            parser.error("--password is required to log senders in before the replay (or pass --no-seed)")
+        records = load_capture(args.capture)
+        seeded = 0
+        if not args.no_seed:
+            seeded = seed_sessions(records, args.url, args.password, args.language, args.workers)
+        report = replay(records, args.url, args.speed, args.workers)
+        report['seeded_senders'] = seeded
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
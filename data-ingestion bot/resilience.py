@@ -0,0 +1,215 @@
+# resilience.py
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('TranscriptionLogger')
+
+# Shared pool for hedged calls. Losing requests keep running in the background,
+# so the pool must outlive any single call.
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+
+# -------------------------------
+# Circuit Breaker
+# -------------------------------
+
+class CircuitBreaker:
+    """Stop calling a backend that keeps failing.
+
+    The breaker opens after `failure_threshold` consecutive failures. While open,
+    calls are rejected immediately. After `reset_timeout` seconds one trial call
+    is let through (half-open): success closes the breaker, failure reopens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit for {self.name} closed.")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit for {self.name} opened after {self._failures} failures.")
+                self._opened_at = time.monotonic()
+
+    def retry_after(self):
+        """Seconds until the breaker lets a trial request through (0 if closed)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+
+# -------------------------------
+# Adaptive Timeouts
+# -------------------------------
+
+def wav_duration(path):
+    """Return the duration of a WAV file in seconds, or None if it can't be read."""
+    try:
+        with wave.open(path, 'rb') as wav_file:
+            rate = wav_file.getframerate()
+            return wav_file.getnframes() / rate if rate else None
+    except (wave.Error, EOFError, OSError):
+        return None
+
+
+def adaptive_timeout(duration, base, per_second, maximum):
+    """Scale the request timeout with the clip length, capped at `maximum`."""
+    if duration is None:
+        return maximum
+    return min(maximum, base + per_second * duration)
+
+
+# -------------------------------
+# Hedged Requests
+# -------------------------------
+
+def hedged_call(targets, call, hedge_delay=None):
+    """Run `call(target)` against `targets` and return the first non-None result.
+
+    The next target is started when the current one fails, or, if `hedge_delay`
+    is set, when it hasn't answered within `hedge_delay` seconds. Returns None if
+    every target failed.
+    """
+    targets = list(targets)
+    pending = set()
+
+    while targets or pending:
+        if targets:
+            pending.add(_hedge_executor.submit(call, targets.pop(0)))
+            timeout = hedge_delay if targets else None
+        else:
+            timeout = None
+
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Hedged call raised: {e}")
+                continue
+            if result is not None:
+                return result
+
+    return None
+
+
+# -------------------------------
+# Retry Queue
+# -------------------------------
+
+class RetryQueue:
+    """Background worker that re-runs failed jobs with exponential backoff.
+
+    `handler(job)` is called from the worker thread. If it raises, the job is
+    scheduled again; an exception carrying a `retry_after` attribute pushes the
+    next attempt back at least that far, and one with `retryable = False`
+    drops the job right away. `on_give_up(job, error)` is called for every
+    dropped job.
+    """
+
+    def __init__(self, handler, base_delay=30, max_delay=900, max_attempts=10, on_give_up=None):
+        self.handler = handler
+        self.on_give_up = on_give_up
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def put(self, job, delay=None, attempt=0):
+        if delay is None:
+            delay = self._backoff(attempt)
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), attempt, job))
+            self._condition.notify()
+        self.start()
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='retry-queue', daemon=True)
+            self._thread.start()
+
+    def _backoff(self, attempt):
+        return min(self.max_delay, self.base_delay * (2 ** attempt))
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._heap:
+                    wait_for = self._heap[0][0] - time.monotonic()
+                    if wait_for <= 0:
+                        _, _, attempt, job = heapq.heappop(self._heap)
+                        return attempt, job
+                    self._condition.wait(wait_for)
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            attempt, job = self._next_job()
+            try:
+                self.handler(job)
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_attempts or not getattr(e, 'retryable', True):
+                    logger.error(f"Giving up on {job} after {attempt} attempts: {e}")
+                    if self.on_give_up:
+                        try:
+                            self.on_give_up(job, e)
+                        except Exception as give_up_error:
+                            logger.error(f"Give-up handler failed for {job}: {give_up_error}")
+                    continue
+                delay = max(self._backoff(attempt), getattr(e, 'retry_after', None) or 0)
+                logger.warning(f"Retry {attempt} for {job} in {delay:.0f}s: {e}")
+                self.put(job, delay=delay, attempt=attempt)
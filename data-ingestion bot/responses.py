@@ -0,0 +1,129 @@
+# responses.py
+
+import json
+import logging
+import os
+import threading
+import time
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
+# WhatsApp text message envelope, split around the recipient and body
+ENVELOPE_HEAD = '{"messaging_product": "whatsapp", "to": '
+ENVELOPE_MIDDLE = ', "type": "text", "text": {"body": '
+ENVELOPE_TAIL = '}}'
+
+
+def text_message_payload(recipient_json, body_json):
+    """Build the JSON request body from an already-encoded recipient and text."""
+    return ENVELOPE_HEAD + recipient_json + ENVELOPE_MIDDLE + body_json + ENVELOPE_TAIL
+
+
+def compile_template(template):
+    """Return a plain string for templates without fields, else a bound formatter."""
+    if any(field is not None for _, field, _, _ in Formatter().parse(template)):
+        return template.format
+    return template
+
+
+class ResponseCatalog:
+    """Localized bot replies, compiled once from bot_responses.json.
+
+    Each entry maps a language code to a template. Templates without fields are
+    stored as ready strings, together with their JSON encoding, so constant
+    replies cost a single dict lookup. Templated replies are rendered per call,
+    since their fields (user names, transcriptions) rarely repeat. A language
+    missing from an entry falls back to `default_language`.
+
+    With `reload_interval` > 0 the file is checked for changes at most that
+    often and reloaded in place.
+    """
+
+    def __init__(self, path, default_language='ru', reload_interval=0):
+        self.path = path
+        self.default_language = default_language
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._compiled = {}
+        self._json = {}
+        self.load()
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        mtime = os.path.getmtime(self.path)
+        if not isinstance(raw, dict):
+            raise ValueError(f"{self.path} must map reply keys to translations")
+
+        compiled = {}
+        encoded = {}
+        for key, translations in raw.items():
+            if not isinstance(translations, dict):
+                raise ValueError(f"Reply '{key}' must map languages to templates")
+            for language, template in translations.items():
+                if not isinstance(template, str):
+                    raise ValueError(f"Reply '{key}' ({language}) is not a string")
+                formatter = compile_template(template)
+                compiled[(key, language)] = formatter
+                if isinstance(formatter, str):
+                    encoded[(key, language)] = json.dumps(formatter, ensure_ascii=False)
+
+        # Swap everything at once so readers never see a half-built catalog
+        with self._lock:
+            self._compiled = compiled
+            self._json = encoded
+            self._mtime = mtime
+        logger.info(f"Loaded {len(compiled)} responses from {self.path}")
+
+    def reload(self):
+        """Reload the file if it changed since the last load.
+
+        A broken file is logged and the current replies are kept until it changes again.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            logger.error(f"Failed to reload {self.path}: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Failed to reload {self.path}, keeping the current replies: {e}")
+            with self._lock:
+                self._mtime = mtime
+
+    def _maybe_reload(self):
+        if self.reload_interval:
+            now = time.monotonic()
+            if now - self._checked_at >= self.reload_interval:
+                self._checked_at = now
+                self.reload()
+
+    def _resolve(self, key, language):
+        if (key, language) in self._compiled:
+            return language
+        return self.default_language
+
+    def text(self, key, language, **fields):
+        """Render reply `key` in `language`; unknown keys give ''."""
+        self._maybe_reload()
+        formatter = self._compiled.get((key, self._resolve(key, language)))
+        if formatter is None:
+            return ''
+        if isinstance(formatter, str):
+            return formatter
+        return formatter(**fields)
+
+    def body_json(self, key, language, **fields):
+        """Like text(), but JSON-encoded, ready for text_message_payload()."""
+        self._maybe_reload()
+        language = self._resolve(key, language)
+        encoded = self._json.get((key, language))
+        if encoded is not None:
+            return encoded
+        return json.dumps(self.text(key, language, **fields), ensure_ascii=False)
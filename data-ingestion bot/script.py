@@ -5,6 +5,8 @@ import requests
 import logging
 from dotenv import load_dotenv
 
+from resilience import CircuitBreaker, adaptive_timeout, hedged_call, wav_duration
+
 # -------------------------------
 # Configuration Section
 # -------------------------------
@@ -15,6 +17,23 @@ MEDIA_DIR = os.getenv('MEDIA_DIR')
 # Transcription API Endpoint
 TRANSCRIPTION_API_URL = os.getenv("TRANSCRIPTION_API_URL")
 
+# Optional comma-separated list of backends, tried in order (overrides TRANSCRIPTION_API_URL)
+TRANSCRIPTION_API_URLS = [
+    url.strip() for url in os.getenv("TRANSCRIPTION_API_URLS", "").split(',') if url.strip()
+] or [TRANSCRIPTION_API_URL]
+
+# Start a hedged request on the next backend after this many seconds without an answer (unset = no hedging)
+TRANSCRIPTION_HEDGE_DELAY = float(os.getenv("TRANSCRIPTION_HEDGE_DELAY")) if os.getenv("TRANSCRIPTION_HEDGE_DELAY") else None
+
+# Timeout = base + per_second * clip duration, capped at max
+TRANSCRIPTION_TIMEOUT_BASE = float(os.getenv("TRANSCRIPTION_TIMEOUT_BASE", "10"))
+TRANSCRIPTION_TIMEOUT_PER_SECOND = float(os.getenv("TRANSCRIPTION_TIMEOUT_PER_SECOND", "2"))
+TRANSCRIPTION_TIMEOUT_MAX = float(os.getenv("TRANSCRIPTION_TIMEOUT_MAX", "60"))
+
+# Circuit breaker per backend
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
 # CSV File to Store Results
 RESULTS_CSV = "results.csv"
 
@@ -60,34 +79,118 @@ def is_wav(filename):
     _, ext = os.path.splitext(filename)
     return ext.lower() in AUDIO_EXTENSIONS
 
-def send_audio_to_api(audio_path):
-    """Send the audio file to the transcription API and return the transcribed text."""
-    if is_wav(audio_path):
+class TranscriptionUnavailable(Exception):
+    """No backend returned a transcription; the job should be retried later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Shared connection pool, so requests reuse open connections to the backends
+http = requests.Session()
+
+class TranscriptionRejected(Exception):
+    """The API refused the audio itself (4xx); retrying won't help."""
+
+    retryable = False
+
+
+# Returned by post_audio for a 4xx response; stops the hedged call early
+REJECTED = object()
+
+breakers = {
+    url: CircuitBreaker(url, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    for url in TRANSCRIPTION_API_URLS
+}
+
+
+def post_audio(url, audio_path, payload, timeout):
+    """Send one transcription request to `url`.
+
+    Returns the text, None on a failure worth retrying, or REJECTED on a client error.
+    """
+    breaker = breakers[url]
+    if not breaker.allow_request():
+        logger.debug(f"Circuit for {url} is open, skipping {audio_path}.")
+        return None
+    files = {
+        'file': (os.path.basename(audio_path), payload, 'audio/wav')  # Adjust MIME type if necessary
+    }
+    try:
+        logger.debug(f"Sending audio file {audio_path} to {url} (timeout {timeout:.0f}s).")
+        response = http.post(url, files=files, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"HTTP request to {url} failed for {audio_path}: {e}")
+        breaker.record_failure()
+        return None
+
+    if response.status_code == 200:
+        breaker.record_success()
+        try:
+            response_data = response.json()
+        except ValueError as e:
+            logger.error(f"Invalid JSON from {url} for {audio_path}: {e}")
+            return None
+        transcribed_text = response_data.get('detection')  # Adjust based on API's response structure
+        if transcribed_text:
+            logger.debug(f"Received transcription for {audio_path}: {transcribed_text}")
+            return transcribed_text
+        else:
+            logger.warning(f"No 'transcript' field in API response for {audio_path}.")
+            return None
+
+    logger.error(f"Transcription API {url} returned status code {response.status_code} for {audio_path}: {response.text}")
+    # Only server-side errors say something about the backend's health
+    if response.status_code >= 500 or response.status_code == 429:
+        breaker.record_failure()
+        return None
+    # Any other client error means the request itself is bad; retrying won't help
+    return REJECTED
+
+
+def warm_up():
+    """Open a connection to every transcription backend before the first request."""
+    for url in TRANSCRIPTION_API_URLS:
         try:
-            with open(audio_path, 'rb') as audio_file:
-                files = {
-                    'file': (os.path.basename(audio_path), audio_file, 'audio/wav')  # Adjust MIME type if necessary
-                }
-                logger.debug(f"Sending audio file {audio_path} to transcription API.")
-                response = requests.post(TRANSCRIPTION_API_URL, files=files, timeout=60)  # Timeout after 60 seconds
-
-                if response.status_code == 200:
-                    response_data = response.json()
-                    transcribed_text = response_data.get('detection')  # Adjust based on API's response structure
-                    if transcribed_text:
-                        logger.debug(f"Received transcription for {audio_path}: {transcribed_text}")
-                        return transcribed_text
-                    else:
-                        logger.warning(f"No 'transcript' field in API response for {audio_path}.")
-                        return "Transcription unavailable."
-                else:
-                    logger.error(f"Transcription API returned status code {response.status_code} for {audio_path}: {response.text}")
-                    return "Transcription failed."
+            http.head(url, timeout=5)
         except requests.exceptions.RequestException as e:
-            logger.error(f"HTTP request failed for {audio_path}: {e}")
-            return "Transcription request error."
-        except Exception as e:
-            logger.error(f"Unexpected error while transcribing {audio_path}: {e}")
-            return "Transcription error."
-    else:
-        return None
\ No newline at end of file
+            logger.warning(f"Warm-up of {url} failed: {e}")
+
+
+def send_audio_to_api(audio_path):
+    """Send the audio file to the transcription API and return the transcribed text.
+
+    Raises TranscriptionUnavailable when every backend failed or is short-circuited,
+    and TranscriptionRejected when the API refused the audio.
+    """
+    if not is_wav(audio_path):
+        return None
+
+    try:
+        with open(audio_path, 'rb') as audio_file:
+            payload = audio_file.read()
+    except OSError as e:
+        raise TranscriptionUnavailable(f"Cannot read {audio_path}: {e}")
+
+    urls = [url for url in TRANSCRIPTION_API_URLS if breakers[url].state != 'open']
+    if not urls:
+        retry_after = min(breaker.retry_after() for breaker in breakers.values())
+        raise TranscriptionUnavailable("All transcription backends are unavailable.", retry_after)
+
+    timeout = adaptive_timeout(
+        wav_duration(audio_path),
+        TRANSCRIPTION_TIMEOUT_BASE,
+        TRANSCRIPTION_TIMEOUT_PER_SECOND,
+        TRANSCRIPTION_TIMEOUT_MAX
+    )
+    transcribed_text = hedged_call(
+        urls,
+        lambda url: post_audio(url, audio_path, payload, timeout),
+        hedge_delay=TRANSCRIPTION_HEDGE_DELAY
+    )
+    if transcribed_text is None:
+        raise TranscriptionUnavailable(f"Transcription failed for {audio_path}.")
+    if transcribed_text is REJECTED:
+        raise TranscriptionRejected(f"Transcription API rejected {audio_path}.")
+    return transcribed_text
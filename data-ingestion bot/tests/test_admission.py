@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def test_slot_limit():
+    controller = AdmissionController({'downloads': 1}, slot_wait=0)
+
+    with controller.slot('downloads'):
+        assert controller.saturated(['downloads'])
+        with pytest.raises(Overloaded):
+            with controller.slot('downloads'):
+                pass
+
+    assert not controller.saturated(['downloads'])
+    assert controller.snapshot()['stages']['downloads'] == {'in_flight': 0, 'limit': 1}
+
+
+def test_slot_waits_for_release():
+    controller = AdmissionController({'downloads': 1})
+    held = controller.slot('downloads')
+    held.__enter__()
+    threading.Timer(0.05, held.__exit__, (None, None, None)).start()
+
+    with controller.slot('downloads', wait=5):
+        pass
+
+
+def test_unlimited_stage():
+    controller = AdmissionController({'downloads': 0}, slot_wait=0)
+
+    with controller.slot('downloads'), controller.slot('downloads'):
+        assert not controller.saturated(['downloads'])
+
+
+def test_disk_budget(tmp_path):
+    (tmp_path / 'old.wav').write_bytes(b'\0' * 60)
+    controller = AdmissionController({}, max_disk_bytes=100, media_dir=str(tmp_path), disk_rescan_interval=0)
+    assert controller.snapshot()['disk']['bytes'] == 60
+
+    controller.add_disk_bytes(50)
+    assert controller.saturated([])
+    with pytest.raises(Overloaded):
+        controller.check([])
+
+    # Another worker's compaction freed space; the rescan picks it up
+    (tmp_path / 'old.wav').unlink()
+    controller.rescan_disk()
+    assert not controller.saturated([])
+    assert controller.level == 'ok'
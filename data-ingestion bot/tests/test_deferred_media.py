@@ -0,0 +1,124 @@
+import os
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def bot(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('bot')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(workdir)
+        patch.setenv('DATABASE_URL', f"sqlite:///{workdir / 'bot.db'}")
+        patch.setenv('SQL_ECHO', 'false')
+        patch.setenv('WARM_UP', 'false')
+        import bot
+        bot.create_app(requeue=False)
+        yield bot
+
+
+@pytest.fixture
+def pipeline(bot, monkeypatch):
+    """Stub out the Graph API and the transcription backend, recording downloads and replies."""
+    calls = {'downloads': [], 'replies': []}
+
+    def download_media(url, media_type, from_number, timestamp, slot_wait=None):
+        calls['downloads'].append(url)
+        extension = 'wav' if media_type in ('audio', 'voice') else 'jpg'
+        return f"media/{len(calls['downloads'])}.{extension}", f"{len(calls['downloads'])}.{extension}", True
+
+    async def send_reply(from_number, message_key, language, **fields):
+        calls['replies'].append(message_key)
+        if message_key in calls.get('failing_replies', ()):
+            raise RuntimeError("Graph API is down")
+
+    monkeypatch.setattr(bot, 'get_media_url', lambda media_id: f"http://graph/{media_id}")
+    monkeypatch.setattr(bot, 'download_media', download_media)
+    monkeypatch.setattr(bot, 'transcribe', lambda filepath, slot_wait=None: 'stub transcription')
+    monkeypatch.setattr(bot, 'fetch_whatsapp_name', lambda phone_num: 'Replay')
+    monkeypatch.setattr(bot, 'send_reply', send_reply)
+    # Jobs are run by hand below, not by the queue's thread
+    monkeypatch.setattr(bot.deferred_media_queue, 'put', lambda job, delay=None, attempt=0: None)
+    return calls
+
+
+def count(bot, model, **filters):
+    session = bot.SessionLocal()
+    try:
+        return session.query(model).filter_by(**filters).count()
+    finally:
+        session.close()
+
+
+def deferred_job(from_number, message_type='voice'):
+    return {
+        'media_id': f"{from_number}-{message_type}",
+        'message_type': message_type,
+        'from_number': from_number,
+        'timestamp': datetime(2026, 10, 19, 12, 0),
+        'language': 'ru',
+    }
+
+
+def test_deferred_voice_note_without_session(bot, pipeline):
+    # Requeued after a restart, or picked up by a worker that never saw this sender
+    job = deferred_job('77000000001')
+    bot.defer_media_job(job)
+    assert job['job_id'] is not None
+
+    bot.process_deferred_media(job)
+    bot.process_deferred_media(job)  # a second delivery finds the job already done
+
+    assert len(pipeline['downloads']) == 1
+    assert count(bot, bot.Message, phone_num='77000000001') == 1
+    assert count(bot, bot.DeferredJob, id=job['job_id']) == 0
+    assert pipeline['replies'] == ['media_deferred']
+    assert '77000000001' not in bot.user_sessions
+
+
+def test_failed_reply_does_not_download_again(bot, pipeline):
+    pipeline['failing_replies'] = {'media_saved'}
+    job = deferred_job('77000000002', message_type='image')
+    bot.defer_media_job(job)
+
+    bot.process_deferred_media(job)  # doesn't raise, so the queue won't retry it
+    bot.process_deferred_media(job)
+
+    assert len(pipeline['downloads']) == 1
+    assert count(bot, bot.Message, phone_num='77000000002') == 1
+    assert count(bot, bot.DeferredJob, id=job['job_id']) == 0
+
+
+def test_deferred_job_lease(bot, pipeline):
+    job = deferred_job('77000000003')
+    bot.defer_media_job(job)
+
+    assert bot.claim_deferred_job(job['job_id'])
+    assert not bot.claim_deferred_job(job['job_id'])
+
+    bot.finish_deferred_job(job['job_id'], done=False)
+    assert bot.claim_deferred_job(job['job_id'])
+
+    bot.finish_deferred_job(job['job_id'], done=True)
+    assert not bot.claim_deferred_job(job['job_id'])
+
+
+def test_relocate_media(bot, pipeline):
+    session = bot.SessionLocal()
+    session.add_all([
+        bot.Message(phone_num='77000000004', attachment_links='media/voice_1.wav'),
+        bot.Message(phone_num='77000000004', attachment_links='media/a.jpg,media/b.jpg'),
+        # '_' must not act as a LIKE wildcard
+        bot.Message(phone_num='77000000004', attachment_links='media/voiceX1.wav'),
+    ])
+    session.commit()
+    session.close()
+
+    bot.relocate_media('media/voice_1.wav', 'media/voice_1.flac')
+    bot.relocate_media('media/b.jpg', 's3://archive/b.jpg')
+    bot.relocate_media('media/voice_1.wav', 'media/voice_1.opus')  # already moved, nothing matches
+
+    session = bot.SessionLocal()
+    links = [m.attachment_links for m in session.query(bot.Message).filter_by(phone_num='77000000004')]
+    session.close()
+    assert links == ['media/voice_1.flac', 'media/a.jpg,s3://archive/b.jpg', 'media/voiceX1.wav']
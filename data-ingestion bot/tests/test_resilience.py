@@ -0,0 +1,63 @@
+import threading
+
+from resilience import RetryQueue
+
+
+class Rejected(Exception):
+    retryable = False
+
+
+def run_until_given_up(handler, **kwargs):
+    given_up = []
+    done = threading.Event()
+
+    def on_give_up(job, error):
+        given_up.append((job, error))
+        done.set()
+
+    queue = RetryQueue(handler, base_delay=0, on_give_up=on_give_up, **kwargs)
+    queue.put('job', delay=0)
+    assert done.wait(5)
+    return given_up
+
+
+def test_gives_up_after_max_attempts():
+    attempts = []
+
+    def handler(job):
+        attempts.append(job)
+        raise RuntimeError("backend down")
+
+    given_up = run_until_given_up(handler, max_attempts=3)
+
+    assert len(attempts) == 3
+    assert [(job, str(error)) for job, error in given_up] == [('job', "backend down")]
+
+
+def test_non_retryable_error_gives_up_at_once():
+    attempts = []
+
+    def handler(job):
+        attempts.append(job)
+        raise Rejected("bad audio")
+
+    given_up = run_until_given_up(handler, max_attempts=10)
+
+    assert len(attempts) == 1
+    assert isinstance(given_up[0][1], Rejected)
+
+
+def test_retries_until_success():
+    attempts = []
+    done = threading.Event()
+
+    def handler(job):
+        attempts.append(job)
+        if len(attempts) < 3:
+            raise RuntimeError("not yet")
+        done.set()
+
+    RetryQueue(handler, base_delay=0, max_attempts=5).put('job', delay=0)
+
+    assert done.wait(5)
+    assert len(attempts) == 3
@@ -0,0 +1,41 @@
+import json
+import os
+
+import pytest
+
+from responses import ResponseCatalog
+
+
+def write_catalog(path, replies, mtime):
+    path.write_text(json.dumps(replies, ensure_ascii=False), encoding='utf-8')
+    os.utime(path, (mtime, mtime))
+
+
+def test_broken_reload_keeps_current_replies(tmp_path):
+    path = tmp_path / 'bot_responses.json'
+    write_catalog(path, {'greeting': {'ru': 'Привет, {name}!'}}, 1000)
+    catalog = ResponseCatalog(str(path))
+
+    broken_files = ({'greeting': {'ru': None}}, {'greeting': ['Привет']}, ['greeting'], '{not json')
+    for mtime, broken in enumerate(broken_files, start=2000):
+        if isinstance(broken, str):
+            path.write_text(broken, encoding='utf-8')
+            os.utime(path, (mtime, mtime))
+        else:
+            write_catalog(path, broken, mtime)
+        catalog.reload()
+        assert catalog._mtime == mtime
+        assert catalog.text('greeting', 'ru', name='Айгуль') == 'Привет, Айгуль!'
+        assert catalog.body_json('greeting', 'kk', name='Айгуль') == '"Привет, Айгуль!"'
+
+    write_catalog(path, {'greeting': {'ru': 'Здравствуйте, {name}!'}}, 3000)
+    catalog.reload()
+    assert catalog.text('greeting', 'ru', name='Айгуль') == 'Здравствуйте, Айгуль!'
+
+
+def test_invalid_catalog_fails_at_startup(tmp_path):
+    path = tmp_path / 'bot_responses.json'
+    write_catalog(path, {'greeting': {'ru': None}}, 1000)
+
+    with pytest.raises(ValueError):
+        ResponseCatalog(str(path))
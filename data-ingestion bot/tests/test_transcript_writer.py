@@ -0,0 +1,49 @@
+import os
+
+from transcript_writer import TranscriptWriter
+
+
+def write_all(directory, records, **kwargs):
+    writer = TranscriptWriter(str(directory), fmt='jsonl', flush_interval=60, **kwargs)
+    for from_number, text, timestamp in records:
+        writer.write(from_number, text, timestamp)
+    writer.close()
+    return writer
+
+
+def test_late_record_after_restart(tmp_path):
+    write_all(tmp_path, [
+        ('a', 'first', '2026-10-18 10:00:00'),
+        ('a', 'second', '2026-10-19 09:00:00'),
+    ])
+    assert os.path.exists(tmp_path / '2026-10-18.jsonl.gz')
+
+    # A new process starts and gets a message stamped before midnight together with today's
+    writer = write_all(tmp_path, [
+        ('b', 'late', '2026-10-18 23:59:00'),
+        ('a', 'third', '2026-10-19 09:05:00'),
+    ])
+
+    assert not os.path.exists(tmp_path / '2026-10-18.jsonl')
+    assert [r['message'] for r in writer.read('a', '2026-10-18')] == ['first']
+    assert writer.read('b', '2026-10-18') == []
+    assert [r['message'] for r in writer.read('b', '2026-10-19')] == ['late']
+    assert [r['message'] for r in writer.read('a', '2026-10-19')] == ['second', 'third']
+
+
+def test_append_to_compressed_day(tmp_path):
+    write_all(tmp_path, [
+        ('a', 'first', '2026-10-18 10:00:00'),
+        ('a', 'second', '2026-10-19 09:00:00'),
+    ])
+
+    # Without compression nothing is redirected, so the record lands next to the .gz
+    writer = write_all(tmp_path, [('b', 'late', '2026-10-18 23:59:00')], compress=False)
+    assert [r['message'] for r in writer.read('a', '2026-10-18')] == ['first']
+    assert [r['message'] for r in writer.read('b', '2026-10-18')] == ['late']
+
+    # Offsets stay valid once the plain part is gzipped onto the existing file
+    writer = write_all(tmp_path, [('a', 'next day', '2026-10-20 08:00:00')])
+    assert not os.path.exists(tmp_path / '2026-10-18.jsonl')
+    assert [r['message'] for r in writer.read('b', '2026-10-18')] == ['late']
+    assert [r['message'] for r in writer.read('a', '2026-10-18')] == ['first']
@@ -0,0 +1,186 @@
+# transcript_writer.py
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def compress_file(path):
+    """Gzip `path` into `path.gz` (appending if it already exists) and remove the original."""
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'ab') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    logger.info(f"Compressed {path}")
+
+
+def gzip_length(path):
+    """Uncompressed size of the gzip file at `path`, 0 if it doesn't exist."""
+    if not os.path.exists(path):
+        return 0
+    with gzip.open(path, 'rb') as f:
+        return f.seek(0, os.SEEK_END)
+
+
+class TranscriptWriter:
+    """Buffer text messages in memory and write them from a background thread.
+
+    Records are flushed when the buffer reaches `flush_bytes` or every
+    `flush_interval` seconds, grouping them so each file is opened once per flush.
+    Files are split by day (taken from the message timestamp) and, with
+    `compress`, gzipped once a newer day starts.
+
+    `fmt='text'` keeps the readable per-user layout, `messages/<day>/<phone>.txt`.
+    `fmt='jsonl'` writes one append-only log per day, `messages/<day>.jsonl`, with
+    `messages/<day>.idx` recording the phone, offset and length of every record.
+    Offsets refer to the uncompressed log, counting any part of the day that was
+    already gzipped.
+    """
+
+    def __init__(self, directory, fmt='text', flush_bytes=65536, flush_interval=5.0, compress=True):
+        if fmt not in ('text', 'jsonl'):
+            raise ValueError(f"Unknown transcript format: {fmt}")
+        self.directory = directory
+        self.fmt = fmt
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._current_day = self._latest_day()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='transcript-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, from_number, text, timestamp):
+        """Queue one message; `timestamp` is a 'YYYY-MM-DD HH:MM:SS' string."""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("TranscriptWriter is closed")
+            self._buffer.append((from_number, text, timestamp))
+            self._buffered_bytes += len(text) + len(from_number) + len(timestamp)
+            if self._buffered_bytes >= self.flush_bytes:
+                self._condition.notify()
+
+    def close(self):
+        """Flush everything still buffered and stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def read(self, from_number, day):
+        """Return the records stored for `from_number` on `day` (jsonl format only)."""
+        if self.fmt != 'jsonl':
+            raise ValueError("Lookups need the jsonl format")
+        index_path = os.path.join(self.directory, f"{day}.idx")
+        log_path = os.path.join(self.directory, f"{day}.jsonl")
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path, encoding='utf-8') as f:
+            entries = [entry for entry in map(json.loads, f) if entry['from'] == from_number]
+        # Records below this offset were moved to the .gz, the rest are still in the plain log
+        compressed_length = gzip_length(log_path + '.gz')
+        records = []
+        for path, opener, start in ((log_path + '.gz', gzip.open, 0), (log_path, open, compressed_length)):
+            part = [entry for entry in entries if (entry['offset'] < compressed_length) == (opener is gzip.open)]
+            if not part:
+                continue
+            with opener(path, 'rb') as f:
+                for entry in part:
+                    f.seek(entry['offset'] - start)
+                    records.append(json.loads(f.read(entry['length'])))
+        return records
+
+    def _latest_day(self):
+        # Newest day already on disk, so late records after a restart aren't written to a compressed day
+        if not os.path.isdir(self.directory):
+            return None
+        if self.fmt == 'text':
+            days = [name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))]
+        else:
+            days = [name.split('.', 1)[0] for name in os.listdir(self.directory)
+                    if name.endswith(('.jsonl', '.jsonl.gz', '.idx'))]
+        return max(days, default=None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed and self._buffered_bytes < self.flush_bytes:
+                    self._condition.wait(self.flush_interval)
+                records, self._buffer = self._buffer, []
+                self._buffered_bytes = 0
+                closed = self._closed
+            if records:
+                try:
+                    self._flush(records)
+                except OSError as e:
+                    logger.error(f"Failed to write {len(records)} messages: {e}")
+            if closed:
+                return
+
+    def _flush(self, records):
+        if self.fmt == 'text':
+            self._flush_text(records)
+        else:
+            self._flush_jsonl(records)
+
+        newest_day = max(timestamp[:10] for _, _, timestamp in records)
+        if self._current_day is None or newest_day > self._current_day:
+            self._current_day = newest_day
+            if self.compress:
+                self._compress_before(newest_day)
+
+    def _flush_text(self, records):
+        grouped = defaultdict(list)
+        for from_number, text, timestamp in records:
+            grouped[(timestamp[:10], from_number)].append(
+                f"Timestamp: {timestamp}\nFrom: {from_number}\nMessage: {text}\n\n"
+            )
+        for (day, from_number), contents in grouped.items():
+            day_dir = os.path.join(self.directory, day)
+            os.makedirs(day_dir, exist_ok=True)
+            with open(os.path.join(day_dir, f"{from_number}.txt"), "a", encoding="utf-8") as f:
+                f.write(''.join(contents))
+
+    def _flush_jsonl(self, records):
+        grouped = defaultdict(list)
+        for from_number, text, timestamp in records:
+            day = timestamp[:10]
+            if self.compress and self._current_day and day < self._current_day:
+                # That day's log may already be compressed; offsets must stay valid
+                day = self._current_day
+            grouped[day].append((from_number, text, timestamp))
+        for day, day_records in grouped.items():
+            index_lines = []
+            log_path = os.path.join(self.directory, f"{day}.jsonl")
+            with open(log_path, "ab") as f:
+                offset = gzip_length(log_path + '.gz') + f.seek(0, os.SEEK_END)
+                chunks = []
+                for from_number, text, timestamp in day_records:
+                    line = json.dumps(
+                        {'timestamp': timestamp, 'from': from_number, 'message': text},
+                        ensure_ascii=False
+                    ).encode('utf-8') + b'\n'
+                    chunks.append(line)
+                    index_lines.append(json.dumps({'from': from_number, 'offset': offset, 'length': len(line)}))
+                    offset += len(line)
+                f.write(b''.join(chunks))
+            with open(os.path.join(self.directory, f"{day}.idx"), "a", encoding="utf-8") as f:
+                f.write('\n'.join(index_lines) + '\n')
+
+    def _compress_before(self, day):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if self.fmt == 'text' and os.path.isdir(path) and name < day:
+                for filename in os.listdir(path):
+                    if filename.endswith('.txt'):
+                        compress_file(os.path.join(path, filename))
+            elif self.fmt == 'jsonl' and name.endswith('.jsonl') and name[:-len('.jsonl')] < day:
+                compress_file(path)